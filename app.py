@@ -1,48 +1,543 @@
-import streamlit as st
-from transformers import AutoTokenizer, AutoModelForTokenClassification, pipeline
+import html
+import logging
+import os
+import queue
 import re
+import shutil
+import tempfile
+import threading
+import warnings
+from collections import defaultdict
+from concurrent.futures import Future
+
+def count_physical_cores():
+    try:
+        cpus = os.sched_getaffinity(0)
+    except AttributeError:
+        # sched_getaffinity and the sysfs topology are Linux-only
+        return os.cpu_count() or 1
+    # Hyperthread siblings share a (package, core) pair and contend for the same FPU
+    cores = set()
+    for cpu in cpus:
+        topology = f"/sys/devices/system/cpu/cpu{cpu}/topology"
+        try:
+            with open(f"{topology}/physical_package_id") as package, open(f"{topology}/core_id") as core:
+                cores.add((package.read().strip(), core.read().strip()))
+        except OSError:
+            # Some containers hide the topology; fall back to logical CPUs
+            return len(cpus)
+    return len(cores)
+
+PHYSICAL_CORES = count_physical_cores()
+NUM_THREADS = os.environ.get("NER_NUM_THREADS", str(min(4, PHYSICAL_CORES)))
+os.environ.setdefault("OMP_NUM_THREADS", NUM_THREADS)
+os.environ.setdefault("MKL_NUM_THREADS", NUM_THREADS)
+
+import requests
+import streamlit as st
+import torch
+from huggingface_hub import snapshot_download
+from transformers import AutoTokenizer, AutoModelForTokenClassification, PreTrainedTokenizerFast, pipeline
+from transformers.modeling_outputs import TokenClassifierOutput
+from transformers.utils import is_flash_attn_2_available
+
+MODEL_REPO = "fairuuz/ner-crime-newest"
+ABBREVIATIONS = (
+    "Jl", "Jln", "Gg", "No", "Kab", "Kec", "Kel", "Ds", "Kp", "Prov", "RT", "RW", "Blok",
+    "H", "Hj", "Dr", "Drs", "Ir", "Sdr", "Sdri", "Tn", "Ny", "Bpk", "St",
+    "AKP", "AKBP", "Kombes", "Kompol", "Brigjen", "Irjen", "Iptu", "Ipda", "Aiptu", "Bripka", "Briptu", "Bripda",
+    "dkk", "dll", "dsb", "tgl", "Rp",
+)
+# Python lookbehinds must be fixed-width, so each abbreviation gets its own
+SENTENCE_BOUNDARY = re.compile(
+    "".join(rf"(?<!\b{abbr}\.)" for abbr in ABBREVIATIONS) + r"(?<=[.!?])\s+",
+    re.IGNORECASE,
+)
+NER_BATCH_SIZE = 8
+NER_MAX_BATCH_SIZE = 16
+NER_REQUEST_TIMEOUT = 120
+MODEL_MAX_LENGTH = 512
+# Each traced bucket adds to load-time peak memory; longer batches run the eager model
+TRACE_BUCKETS = (64, 128)
+# "onnx" (default) or "torch" run locally; "api" uses the Inference API with a local fallback
+NER_BACKENDS = ("onnx", "torch", "api")
+NER_BACKEND = os.environ.get("NER_BACKEND", "onnx")
+if NER_BACKEND not in NER_BACKENDS:
+    raise ValueError(f"NER_BACKEND={NER_BACKEND!r} tidak dikenal, pilih salah satu dari {', '.join(NER_BACKENDS)}")
+# PyTorch backend only: "compile" (default) uses torch.compile, "jit" TorchScript trace+freeze
+# (deprecated since torch 2.14), "none" plain eager
+TORCH_OPTIMIZATIONS = ("compile", "jit", "none")
+TORCH_OPTIMIZATION = os.environ.get("NER_TORCH_OPTIMIZATION", "compile")
+if TORCH_OPTIMIZATION not in TORCH_OPTIMIZATIONS:
+    raise ValueError(
+        f"NER_TORCH_OPTIMIZATION={TORCH_OPTIMIZATION!r} tidak dikenal, pilih salah satu dari {', '.join(TORCH_OPTIMIZATIONS)}"
+    )
+PERSISTENT_CACHE_DIR = "/mount/data/hf-cache"
+
+def get_hf_cache_dir():
+    if os.environ.get("NER_HF_CACHE_DIR"):
+        return os.environ["NER_HF_CACHE_DIR"]
+    if os.path.isdir(PERSISTENT_CACHE_DIR) and os.access(PERSISTENT_CACHE_DIR, os.W_OK):
+        return PERSISTENT_CACHE_DIR
+    # None keeps the standard Hugging Face cache location
+    return None
+
+HF_CACHE_DIR = get_hf_cache_dir()
+ONNX_CACHE_DIR = os.environ.get(
+    "NER_ONNX_CACHE_DIR", os.path.join(HF_CACHE_DIR, "onnx") if HF_CACHE_DIR else ".onnx-cache"
+)
+ONNX_QUANTIZED_FILE = "model_quantized.onnx"
+# config.json and tokenizer files, plus a single weight format for the model
+TOKENIZER_FILES = ("*.json", "*.txt", "*.model")
+MODEL_FILES = TOKENIZER_FILES + ("*.safetensors",)
+LEGACY_MODEL_FILES = TOKENIZER_FILES + ("pytorch_model*.bin",)
+# The serverless Inference API doesn't serve community models, so this must be a dedicated endpoint
+INFERENCE_API_URL = os.environ.get("NER_API_URL")
+if NER_BACKEND == "api" and not INFERENCE_API_URL:
+    raise ValueError("NER_BACKEND=api membutuhkan NER_API_URL (URL Inference Endpoint khusus)")
+INFERENCE_API_TIMEOUT = 30
+# Tokens whose FP32 top-two logits are this far apart must keep their label after quantization
+QUANTIZATION_MIN_MARGIN = 1.0
+QUANTIZATION_REJECTED_SUFFIX = ".rejected"
+QUANTIZATION_CHECK_TEXT = (
+    "Pada tanggal 15 Januari 2024, Kepolisian Resor Jakarta Selatan menangkap tersangka bernama Ahmad Sutrisno "
+    "di kawasan Kemang dengan barang bukti uang tunai Rp 2.500.000 dan sebilah pisau lipat."
+)
+
+def get_hf_token():
+    if os.environ.get("HF_TOKEN"):
+        return os.environ["HF_TOKEN"]
+    try:
+        return st.secrets.get("HF_TOKEN")
+    except FileNotFoundError:
+        return None
+
+HF_TOKEN = get_hf_token()
+
+def count_quantization_flips(fp32_model, quantized_model, tokenizer):
+    inputs = tokenizer(QUANTIZATION_CHECK_TEXT, return_tensors="pt")
+    fp32_logits = fp32_model(**inputs).logits
+    quantized_labels = quantized_model(**inputs).logits.argmax(-1)
+    top2 = fp32_logits.topk(2, dim=-1).values
+    # Low-margin tokens may flip from rounding alone; u8/s8 saturation on CPUs
+    # without VNNI also flips the confident ones
+    confident = (top2[..., 0] - top2[..., 1]) >= QUANTIZATION_MIN_MARGIN
+    return int((confident & (fp32_logits.argmax(-1) != quantized_labels)).sum())
+
+def remove_stale_revisions(repo_dir, revision):
+    for name in os.listdir(repo_dir):
+        if name in (revision, revision + QUANTIZATION_REJECTED_SUFFIX):
+            continue
+        path = os.path.join(repo_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+
+def load_onnx_model(repo, tokenizer):
+    import onnxruntime
+    from optimum.onnxruntime import ORTModelForTokenClassification, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    # Snapshot dirs are named after the hub commit, so a new revision gets a fresh export
+    revision = os.path.basename(download_model(TOKENIZER_FILES))
+    repo_dir = os.path.join(ONNX_CACHE_DIR, repo.replace("/", "--"))
+    save_dir = os.path.join(repo_dir, revision)
+    rejected_marker = save_dir + QUANTIZATION_REJECTED_SUFFIX
+    if os.path.exists(rejected_marker):
+        # Skip the weight download and export this revision already failed
+        raise RuntimeError(f"INT8 model for revision {revision} was rejected earlier")
+    if not os.path.exists(os.path.join(save_dir, ONNX_QUANTIZED_FILE)):
+        # Quantize into a temp dir on the same disk and move it in only once complete,
+        # so a killed process never leaves a partial model_quantized.onnx behind
+        os.makedirs(repo_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=ONNX_CACHE_DIR)
+        try:
+            # Only an export needs the PyTorch weights
+            model = ORTModelForTokenClassification.from_pretrained(download_model_weights(), export=True)
+            quantizer = ORTQuantizer.from_pretrained(model)
+            qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=True)
+            quantizer.quantize(save_dir=tmp_dir, quantization_config=qconfig)
+            flips = count_quantization_flips(
+                model, ORTModelForTokenClassification.from_pretrained(tmp_dir, file_name=ONNX_QUANTIZED_FILE), tokenizer
+            )
+            if flips:
+                open(rejected_marker, "w").close()
+                remove_stale_revisions(repo_dir, revision)
+                raise RuntimeError(f"INT8 model changed {flips} confident token label(s) from FP32")
+            shutil.rmtree(save_dir, ignore_errors=True)
+            os.replace(tmp_dir, save_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        remove_stale_revisions(repo_dir, revision)
+    session_options = onnxruntime.SessionOptions()
+    # Already ORT's default; kept explicit because passing session_options replaces optimum's.
+    # Fusing the FP32 graph with ORTOptimizer before quantizing measured slower (QAttention)
+    session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session_options.intra_op_num_threads = int(NUM_THREADS)
+    return ORTModelForTokenClassification.from_pretrained(
+        save_dir,
+        file_name=ONNX_QUANTIZED_FILE,
+        provider="CPUExecutionProvider",
+        session_options=session_options,
+    )
+
+def select_torch_dtype():
+    if torch.cuda.is_available():
+        return "cuda", torch.float16
+    try:
+        if torch.cpu._is_avx512_bf16_supported():
+            return "cpu", torch.bfloat16
+    except AttributeError:
+        pass
+    return "cpu", torch.float32
+
+def traced_logits(graph, args):
+    output = graph(*args)
+    return output["logits"] if isinstance(output, dict) else output[0]
+
+def has_weight_copies(graph, model):
+    # Frozen graphs inline weights as constants; folding passes could give each bucket its own copy.
+    # Traces also bake in small tensors of their own (e.g. the attention mask's 1.0), so only a
+    # meaningful share of the weight bytes counts
+    storages = {tensor.untyped_storage().data_ptr() for tensor in (*model.parameters(), *model.buffers())}
+    constants = (node.output().toIValue() for node in graph.graph.nodes() if node.kind() == "prim::Constant")
+    copied_bytes = sum(
+        constant.numel() * constant.element_size()
+        for constant in constants
+        if isinstance(constant, torch.Tensor) and constant.untyped_storage().data_ptr() not in storages
+    )
+    return copied_bytes * 100 >= sum(param.numel() * param.element_size() for param in model.parameters())
+
+def trace_torch_model(model, tokenizer):
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in tokenizer.model_input_names]
+    pad_values = {"input_ids": tokenizer.pad_token_id, "attention_mask": 0, "token_type_ids": 0}
+    tolerance = 1e-4 if model.dtype == torch.float32 else 5e-2
+    eager_forward = model.forward
+    # Traced graphs are only valid for the traced shape, so trace one graph per length bucket
+    traced = {}
+    with torch.no_grad(), warnings.catch_warnings():
+        # torch>=2.14 warns that TorchScript is deprecated on every trace/freeze call;
+        # "jit" is an explicit opt-in, so don't repeat that on each load
+        warnings.filterwarnings("ignore", message=r"`torch\.jit\.\w+` is deprecated", category=FutureWarning)
+        for length in TRACE_BUCKETS:
+            dummy = tokenizer(
+                ["warmup text"] * NER_BATCH_SIZE, return_tensors="pt", padding="max_length", max_length=length
+            ).to(model.device)
+            args = tuple(dummy[name] for name in input_names)
+            graph = torch.jit.freeze(torch.jit.trace(model, args, strict=False))
+            if not torch.allclose(traced_logits(graph, args).float(), model(*args).logits.float(), atol=tolerance):
+                raise RuntimeError(f"Traced logits differ from eager at length {length}")
+            if has_weight_copies(graph, model):
+                raise RuntimeError(f"Frozen graph duplicates model weights at length {length}")
+            traced[length] = graph
+
+    def forward(input_ids=None, attention_mask=None, token_type_ids=None, **kwargs):
+        batch_size, seq_len = input_ids.shape
+        length = next((bucket for bucket in TRACE_BUCKETS if bucket >= seq_len), None)
+        if length is None:
+            return eager_forward(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
+        inputs = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask if attention_mask is not None else torch.ones_like(input_ids),
+            "token_type_ids": token_type_ids if token_type_ids is not None else torch.zeros_like(input_ids),
+        }
+        logits = []
+        for start in range(0, batch_size, NER_BATCH_SIZE):
+            rows = min(NER_BATCH_SIZE, batch_size - start)
+            padding = (0, length - seq_len, 0, NER_BATCH_SIZE - rows)
+            args = [torch.nn.functional.pad(inputs[name][start:start + rows], padding, value=pad_values[name]) for name in input_names]
+            logits.append(traced_logits(traced[length], args)[:rows, :seq_len])
+        return TokenClassifierOutput(logits=torch.cat(logits))
+
+    # Swap forward only so the pipeline still sees a PreTrainedModel
+    model.forward = forward
+    return model
+
+def load_torch_model(model_dir, tokenizer):
+    device, dtype = select_torch_dtype()
+    attn_implementation = "flash_attention_2" if device == "cuda" and is_flash_attn_2_available() else "sdpa"
+    try:
+        model = AutoModelForTokenClassification.from_pretrained(
+            model_dir,
+            dtype=dtype,
+            low_cpu_mem_usage=True,
+            attn_implementation=attn_implementation,
+        )
+    except (ValueError, ImportError):
+        # Architecture or installed transformers doesn't support it; use the default attention
+        logging.getLogger(__name__).warning("attn_implementation=%s unsupported", attn_implementation, exc_info=True)
+        model = AutoModelForTokenClassification.from_pretrained(model_dir, dtype=dtype, low_cpu_mem_usage=True)
+    model = model.to(device).eval()
+    if TORCH_OPTIMIZATION == "jit":
+        try:
+            return trace_torch_model(model, tokenizer)
+        except Exception:
+            logging.getLogger(__name__).warning("TorchScript tracing failed, using eager PyTorch", exc_info=True)
+            return model
+    if TORCH_OPTIMIZATION == "compile":
+        eager_forward = model.forward
+        # reduce-overhead relies on CUDA graphs and does nothing on CPU
+        mode = "reduce-overhead" if device == "cuda" else "default"
+        # Compile forward only so the pipeline still sees a PreTrainedModel
+        model.forward = torch.compile(eager_forward, mode=mode, dynamic=True)
+        try:
+            # Compilation is lazy, so run it now to surface toolchain errors. Dynamo specializes
+            # size-1 dims, so compile both a multi-sentence batch and a single sentence
+            with torch.inference_mode():
+                for texts in (["warmup", "warmup text"], ["warmup"]):
+                    model(**tokenizer(texts, return_tensors="pt", padding=True).to(device))
+        except Exception:
+            logging.getLogger(__name__).warning("torch.compile failed, using eager PyTorch", exc_info=True)
+            model.forward = eager_forward
+    return model
 
 @st.cache_resource
-def load_model():
-    tokenizer = AutoTokenizer.from_pretrained("fairuuz/ner-crime-newest")
-    model = AutoModelForTokenClassification.from_pretrained("fairuuz/ner-crime-newest")
-    ner_pipe = pipeline("ner", model=model, tokenizer=tokenizer, aggregation_strategy="simple")
+def download_model(allow_patterns):
+    return snapshot_download(repo_id=MODEL_REPO, cache_dir=HF_CACHE_DIR, allow_patterns=list(allow_patterns))
+
+def download_model_weights():
+    model_dir = download_model(MODEL_FILES)
+    if not any(name.endswith(".safetensors") for name in os.listdir(model_dir)):
+        model_dir = download_model(LEGACY_MODEL_FILES)
+    return model_dir
+
+@st.cache_resource
+def load_tokenizer():
+    tokenizer = AutoTokenizer.from_pretrained(download_model(TOKENIZER_FILES), use_fast=True, model_max_length=MODEL_MAX_LENGTH)
+    # aggregation_strategy="simple" relies on the offset mapping of a fast tokenizer
+    if not isinstance(tokenizer, PreTrainedTokenizerFast):
+        raise TypeError(f"{MODEL_REPO} tidak menyediakan fast tokenizer")
+    return tokenizer
+
+def build_pipeline(model, tokenizer):
+    ner_pipe = pipeline(
+        "ner",
+        model=model,
+        tokenizer=tokenizer,
+        aggregation_strategy="simple",
+        stride=32,
+        ignore_labels=["O"],
+        device=model.device,
+    )
+    if isinstance(ner_pipe.model, torch.nn.Module):
+        ner_pipe.model.eval()
+    with torch.inference_mode():
+        ner_pipe(["warmup", "warmup text"], batch_size=NER_BATCH_SIZE)
     return ner_pipe
 
-def get_entity_color(entity_type, theme='Light'):
-    light_colors = {
-        'LOC': '#D5F5E3', 'NOR': '#D6EAF8', 'LAW': '#FDEDEC', 'DAT': '#FEF9E7',
-        'PER': '#E8F8F5', 'CRIMETYPE': '#FADBD8', 'EVIDENCE': '#EBDEF0'
-    }
-    dark_colors = {
-        'LOC': '#2ECC71', 'NOR': '#3498DB', 'LAW': '#E74C3C', 'DAT': '#F1C40F',
-        'PER': '#1ABC9C', 'CRIMETYPE': '#E67E22', 'EVIDENCE': '#9B59B6'
-    }
-    if theme == 'Dark':
-        return dark_colors.get(entity_type, '#7F8C8D')
-    return light_colors.get(entity_type, '#F2F3F4')
+@st.cache_resource
+def load_model():
+    torch.set_num_threads(int(NUM_THREADS))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set once per process, before any inter-op work starts
+        pass
+    tokenizer = load_tokenizer()
+    if NER_BACKEND != "torch":
+        try:
+            return build_pipeline(load_onnx_model(MODEL_REPO, tokenizer), tokenizer)
+        except Exception:
+            # Missing optimum, failed export/quantization/check, unwritable cache or an ORT runtime error
+            logging.getLogger(__name__).warning("ONNX backend unavailable, using PyTorch", exc_info=True)
+    return build_pipeline(load_torch_model(download_model_weights(), tokenizer), tokenizer)
+
+def split_segments(text):
+    segments = []
+    cursor = 0
+    for match in SENTENCE_BOUNDARY.finditer(text):
+        segments.append((cursor, text[cursor:match.start()]))
+        cursor = match.end()
+    segments.append((cursor, text[cursor:]))
+    return [(offset, segment) for offset, segment in segments if segment.strip()]
+
+def query_inference_api(segments):
+    response = requests.post(
+        INFERENCE_API_URL,
+        headers={"Authorization": f"Bearer {HF_TOKEN}"} if HF_TOKEN else {},
+        json={"inputs": segments, "parameters": {"aggregation_strategy": "simple"}},
+        timeout=INFERENCE_API_TIMEOUT,
+    )
+    response.raise_for_status()
+    results = response.json()
+    # A 200 can still carry {"error": ...} or drop segments; treat that as a failed request
+    if (
+        not isinstance(results, list)
+        or len(results) != len(segments)
+        or not all(isinstance(segment_entities, list) for segment_entities in results)
+    ):
+        raise requests.RequestException(f"Respons Inference API tidak valid: {str(results)[:200]}", response=response)
+    return results
+
+def has_long_segment(tokenizer, segments):
+    # A character yields at most two tokens (SentencePiece may add a bare word-start piece),
+    # so only segments that could exceed the window are tokenized
+    segments = [segment for segment in segments if 2 * len(segment) + 2 > MODEL_MAX_LENGTH]
+    if not segments:
+        return False
+    # verbose=False skips the "sequence length is longer than the maximum" log
+    return any(len(ids) > MODEL_MAX_LENGTH for ids in tokenizer(segments, verbose=False)["input_ids"])
+
+class NERBatcher:
+    """Runs segments from concurrent sessions through one pipeline call on a worker thread."""
+
+    def __init__(self, ner):
+        self.ner = ner
+        self.requests = queue.Queue()
+        self.stopped = threading.Event()
+        # Daemon so a forgotten batcher never keeps the process alive on shutdown
+        self.worker = threading.Thread(target=self.run, name="ner-batcher", daemon=True)
+        self.worker.start()
+
+    def predict(self, segments):
+        if self.stopped.is_set():
+            raise RuntimeError("Model NER sudah dihentikan")
+        future = Future()
+        self.requests.put((segments, future))
+        return future.result(timeout=NER_REQUEST_TIMEOUT)
+
+    def stop(self):
+        self.stopped.set()
+        # Wake the worker if it is waiting for requests
+        self.requests.put(None)
+        self.worker.join(timeout=NER_REQUEST_TIMEOUT)
+
+    def next_batch(self):
+        request = self.requests.get()
+        if request is None:
+            return []
+        batch = [request]
+        size = len(request[0])
+        # Everything queued while the previous batch ran joins this one
+        while size < NER_MAX_BATCH_SIZE:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    def run(self):
+        while not self.stopped.is_set():
+            batch = self.next_batch()
+            if not batch:
+                continue
+            texts = [text for segments, _ in batch for text in segments]
+            try:
+                # Autograd state is thread-local, so inference mode must be entered on this thread
+                with torch.inference_mode():
+                    outputs = self.ner(texts, batch_size=NER_BATCH_SIZE)
+                # The fast tokenizer isn't safe to share across threads, so it is only used here
+                long_segments = [has_long_segment(self.ner.tokenizer, segments) for segments, _ in batch]
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            cursor = 0
+            for (segments, future), long_segment in zip(batch, long_segments):
+                future.set_result((outputs[cursor:cursor + len(segments)], long_segment))
+                cursor += len(segments)
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                request[1].set_exception(RuntimeError("Model NER sudah dihentikan"))
+        # Drop the pipeline so a released batcher doesn't keep the model alive
+        self.ner = None
+
+@st.cache_resource(on_release=NERBatcher.stop)
+def get_ner_host():
+    return NERBatcher(load_model())
+
+def merge_entities(segments, raw_entities):
+    entities = []
+    for (offset, _), segment_entities in zip(segments, raw_entities):
+        for ent in segment_entities:
+            entities.append({**ent, 'start': ent['start'] + offset, 'end': ent['end'] + offset})
+    return entities
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def run_ner(text):
+    segments = split_segments(text)
+    if not segments:
+        return [], False
+    texts = [segment for _, segment in segments]
+    if NER_BACKEND == "api":
+        try:
+            return merge_entities(segments, query_inference_api(texts)), False
+        except requests.RequestException:
+            # Endpoint unavailable (e.g. 503 while the model is loading), use the local model
+            pass
+    # Only the local pipeline windows over-long segments with its stride
+    raw_entities, long_segment = get_ner_host().predict(texts)
+    return merge_entities(segments, raw_entities), long_segment
+
+ENTITY_TYPES = {
+    'LOC': 'Lokasi', 'NOR': 'Organisasi', 'LAW': 'Hukum', 'DAT': 'Tanggal/Waktu',
+    'PER': 'Person', 'CRIMETYPE': 'Jenis Kejahatan', 'EVIDENCE': 'Barang Bukti'
+}
+LIGHT_COLORS = {
+    'LOC': '#D5F5E3', 'NOR': '#D6EAF8', 'LAW': '#FDEDEC', 'DAT': '#FEF9E7',
+    'PER': '#E8F8F5', 'CRIMETYPE': '#FADBD8', 'EVIDENCE': '#EBDEF0', 'DEFAULT': '#F2F3F4'
+}
+DARK_COLORS = {
+    'LOC': '#2ECC71', 'NOR': '#3498DB', 'LAW': '#E74C3C', 'DAT': '#F1C40F',
+    'PER': '#1ABC9C', 'CRIMETYPE': '#E67E22', 'EVIDENCE': '#9B59B6', 'DEFAULT': '#7F8C8D'
+}
+
+def get_palette(theme='Light'):
+    return DARK_COLORS if theme == 'Dark' else LIGHT_COLORS
+
+def get_entity_color(entity_type, palette):
+    return palette.get(entity_type, palette['DEFAULT'])
+
+def build_legend_html(theme):
+    palette = get_palette(theme)
+    legend_text_color = "black" if theme == 'Light' else "white"
+    border_color = "#E0E0E0" if theme == 'Light' else "#444"
+    legend_html = ""
+    for etype, desc in ENTITY_TYPES.items():
+        color = get_entity_color(etype, palette)
+        legend_html += f'<span style="background-color: {color}; color: {legend_text_color}; padding: 0.4rem 0.8rem; margin: 5px 5px 5px 0; display: inline-block; border-radius: 8px; border: 1px solid {border_color};">{desc} ({etype})</span>'
+    return legend_html
+
+LEGEND_HTML_LIGHT = build_legend_html('Light')
+LEGEND_HTML_DARK = build_legend_html('Dark')
+
+SPAN_TMPL = (
+    '<span style="background-color: %(c)s; color: %(tc)s; padding: 0.3em 0.5em; margin: 0 0.2em; line-height: 1; border-radius: 0.35em;" '
+    'title="%(et)s (Score: %(sc).2f)">'
+    '%(w)s'
+    ' <strong style="font-size: 0.8em; font-weight: bold;">%(et)s</strong>'
+    '</span>'
+)
 
 def highlight_entities(text, entities, theme='Light'):
     if not entities:
-        return text
+        return html.escape(text)
+    palette = get_palette(theme)
     highlight_text_color = "black" if theme == 'Light' else "white"
-    sorted_entities = sorted(entities, key=lambda x: x['start'], reverse=True)
-    highlighted_text = text
-    for entity in sorted_entities:
-        start = entity['start']
-        end = entity['end']
-        word = entity['word']
+    parts = []
+    cursor = 0
+    for entity in sorted(entities, key=lambda x: x['start']):
         entity_type = entity['entity_group']
-        color = get_entity_color(entity_type, theme)
-        replacement = (
-            f'<span style="background-color: {color}; color: {highlight_text_color}; padding: 0.3em 0.5em; margin: 0 0.2em; line-height: 1; border-radius: 0.35em;" '
-            f'title="{entity_type} (Score: {entity["score"]:.2f})">'
-            f'{word}'
-            f' <strong style="font-size: 0.8em; font-weight: bold;">{entity_type}</strong>'
-            '</span>'
-        )
-        highlighted_text = highlighted_text[:start] + replacement + highlighted_text[end:]
-    return highlighted_text
+        parts.append(html.escape(text[cursor:entity['start']]))
+        parts.append(SPAN_TMPL % {
+            "c": get_entity_color(entity_type, palette),
+            "tc": highlight_text_color,
+            "et": entity_type,
+            "sc": entity["score"],
+            "w": html.escape(entity['word']),
+        })
+        cursor = entity['end']
+    parts.append(html.escape(text[cursor:]))
+    return "".join(parts)
 
 st.set_page_config(
     page_title="NER Crime News Analysis",
@@ -54,6 +549,7 @@ st.set_page_config(
 # === Sidebar ===
 st.sidebar.title("Pengaturan Tampilan")
 theme = st.sidebar.radio("Pilih Tema Aplikasi", ["Light", "Dark"])
+palette = get_palette(theme)
 threshold = st.sidebar.slider("Threshold Confidence Score", 0.0, 1.0, 0.6, 0.01)
 st.sidebar.markdown("Nilai minimum kepercayaan agar entitas dianggap valid.")
 
@@ -68,16 +564,18 @@ if theme == 'Dark':
         </style>
     """, unsafe_allow_html=True)
 
-try:
-    ner = load_model()
-    model_loaded = True
-except Exception as e:
-    model_loaded = False
-    st.error(f"Error memuat model: {str(e)}")
-
 st.title("NER Crime News Analysis 🔍")
 st.markdown("Sistem analisis dan ekstraksi entitas dari berita kriminalitas Indonesia menggunakan Named Entity Recognition (NER).")
 
+model_loaded = True
+if NER_BACKEND != "api":
+    with st.spinner("Memuat model NER..."):
+        try:
+            get_ner_host()
+        except Exception as e:
+            model_loaded = False
+            st.error(f"Error memuat model: {str(e)}")
+
 col1, col2 = st.columns([1, 1], gap="large")
 
 with col1:
@@ -98,62 +596,56 @@ with col1:
     analyze_button = st.button("Analisis Entitas", type="primary", use_container_width=True)
 
     st.subheader("Daftar Entitas")
-    entity_types = {
-        'LOC': 'Lokasi', 'NOR': 'Organisasi', 'LAW': 'Hukum', 'DAT': 'Tanggal/Waktu',
-        'PER': 'Person', 'CRIMETYPE': 'Jenis Kejahatan', 'EVIDENCE': 'Barang Bukti'
-    }
-    legend_html = ""
-    legend_text_color = "black" if theme == 'Light' else "white"
-    for etype, desc in entity_types.items():
-        color = get_entity_color(etype, theme)
-        border_color = "#E0E0E0" if theme == 'Light' else "#444"
-        legend_html += f'<span style="background-color: {color}; color: {legend_text_color}; padding: 0.4rem 0.8rem; margin: 5px 5px 5px 0; display: inline-block; border-radius: 8px; border: 1px solid {border_color};">{desc} ({etype})</span>'
-    st.markdown(legend_html, unsafe_allow_html=True)
+    st.markdown(LEGEND_HTML_DARK if theme == 'Dark' else LEGEND_HTML_LIGHT, unsafe_allow_html=True)
 
 with col2:
     st.subheader("Hasil Analisis")
     result_bg_color = "#F8F9F9" if theme == 'Light' else "#1C2833"
     result_border_color = "#E0E0E0" if theme == 'Light' else "#31333F"
 
-    if model_loaded and analyze_button and text_input.strip():
+    if analyze_button and text_input.strip():
+        st.session_state["analyzed_text"] = text_input
+    analyzed_text = st.session_state.get("analyzed_text")
+
+    if analyze_button and not text_input.strip():
+        st.warning("Harap masukkan teks terlebih dahulu untuk dianalisis.")
+    elif model_loaded and analyzed_text:
         with st.spinner("Menganalisis teks..."):
             try:
-                raw_entities = ner(text_input)
+                raw_entities, long_segment = run_ner(analyzed_text)
+                if long_segment:
+                    st.info(f"Ada kalimat yang melebihi {MODEL_MAX_LENGTH} token — kalimat tersebut diproses dalam beberapa potongan.")
                 entities = [ent for ent in raw_entities if ent['score'] >= threshold]
 
                 if entities:
-                    highlighted = highlight_entities(text_input, entities, theme)
+                    highlighted = highlight_entities(analyzed_text, entities, theme)
                     st.markdown(
                         f'<div style="line-height: 2.2; font-size: 1.1rem; padding: 1.5rem; background-color: {result_bg_color}; border-radius: 8px; border: 1px solid {result_border_color};">{highlighted}</div>',
                         unsafe_allow_html=True
                     )
 
                     st.markdown("<h5 style='margin-top: 2rem;'>Daftar Entitas Terdeteksi</h5>", unsafe_allow_html=True)
-                    entity_groups = {}
+                    entity_groups = defaultdict(list)
                     for ent in entities:
-                        entity_type = ent['entity_group']
-                        if entity_type not in entity_groups:
-                            entity_groups[entity_type] = []
-                        entity_groups[entity_type].append(ent)
+                        entity_groups[ent['entity_group']].append(ent)
+                    sorted_groups = sorted(entity_groups.items())
 
-                    for entity_type, group_entities in sorted(entity_groups.items()):
-                        header_color = get_entity_color(entity_type, theme)
+                    for entity_type, group_entities in sorted_groups:
+                        header_color = get_entity_color(entity_type, palette)
                         header_text_color = "black" if theme == 'Light' else "white"
                         st.markdown(
-                            f'<div style="background-color: {header_color}; color: {header_text_color}; padding: 0.5rem 1rem; margin-top: 1rem; border-radius: 5px; font-weight: bold;">{entity_types.get(entity_type, entity_type)} ({entity_type})</div>',
+                            f'<div style="background-color: {header_color}; color: {header_text_color}; padding: 0.5rem 1rem; margin-top: 1rem; border-radius: 5px; font-weight: bold;">{ENTITY_TYPES.get(entity_type, entity_type)} ({entity_type})</div>',
                             unsafe_allow_html=True
                         )
                         for ent in sorted(group_entities, key=lambda x: x['score'], reverse=True):
                             score = ent['score']
-                            st.markdown(f"&nbsp;&nbsp;&nbsp;&nbsp;- **{ent['word']}** (Score: {score:.3f})")
+                            st.markdown(f"&nbsp;&nbsp;&nbsp;&nbsp;- **{html.escape(ent['word'])}** (Score: {score:.3f})")
                 else:
                     st.info("Tidak ada entitas yang terdeteksi dalam teks yang diberikan.")
 
             except Exception as e:
                 st.error(f"Terjadi error saat analisis: {str(e)}")
 
-    elif analyze_button and not text_input.strip():
-        st.warning("Harap masukkan teks terlebih dahulu untuk dianalisis.")
     else:
         st.info("Hasil analisis akan ditampilkan di sini setelah Anda menekan tombol 'Analisis Entitas'.")
 